@@ -7,16 +7,24 @@ from .models import ChatAttachment, ChatMessage, ChatSession
 class ChatSessionAdmin(admin.ModelAdmin):
     list_display = ("id", "user", "title", "updated_at")
     search_fields = ("title", "user__username")
+    list_select_related = ("user",)
+    autocomplete_fields = ("user",)
 
 
 @admin.register(ChatMessage)
 class ChatMessageAdmin(admin.ModelAdmin):
     list_display = ("id", "session", "role", "created_at")
     search_fields = ("content",)
+    list_filter = ("role", "created_at")
+    list_select_related = ("session",)
+    raw_id_fields = ("session",)
+    list_per_page = 50
 
 
 @admin.register(ChatAttachment)
 class ChatAttachmentAdmin(admin.ModelAdmin):
     list_display = ("id", "message", "byte_size", "created_at")
+    list_select_related = ("message",)
+    raw_id_fields = ("message",)
 
 # Register your models here.
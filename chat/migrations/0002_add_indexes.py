@@ -0,0 +1,28 @@
+# Generated manually for chat list/pagination indexes.
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="chatsession",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name="chatmessage",
+            index=models.Index(fields=["session", "created_at"], name="chatmsg_sess_created_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="chatmessage",
+            index=models.Index(fields=["role"], name="chatmsg_role_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="chatattachment",
+            index=models.Index(fields=["message", "created_at"], name="chatatt_msg_created_idx"),
+        ),
+    ]
@@ -0,0 +1,15 @@
+# Generated manually for the sidebar session listing.
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("chat", "0002_add_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="chatsession",
+            index=models.Index(fields=["user", "-updated_at"], name="chat_session_user_updated_idx"),
+        ),
+    ]
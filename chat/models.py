@@ -4,15 +4,34 @@ from django.conf import settings
 from django.db import models
 
 
+class ChatSessionQuerySet(models.QuerySet):
+    def with_messages(self, attachments: bool = True):
+        # Only prefetch attachments when the caller renders them; it is an extra query per call.
+        messages = ChatMessage.objects.order_by('created_at')
+        if attachments:
+            messages = messages.with_attachments()
+        return self.prefetch_related(models.Prefetch('messages', queryset=messages))
+
+
+class ChatMessageQuerySet(models.QuerySet):
+    def with_attachments(self):
+        return self.prefetch_related('attachments')
+
+
 class ChatSession(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     title = models.CharField(max_length=200, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    updated_at = models.DateTimeField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = ChatSessionQuerySet.as_manager()
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['user', '-updated_at'], name='chat_session_user_updated_idx'),
+        ]
 
     def __str__(self) -> str:
         return self.title or f"Chat {self.created_at:%Y-%m-%d %H:%M}"
@@ -29,8 +48,14 @@ class ChatMessage(models.Model):
     content = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ChatMessageQuerySet.as_manager()
+
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['session', 'created_at'], name='chatmsg_sess_created_idx'),
+            models.Index(fields=['role'], name='chatmsg_role_idx'),
+        ]
 
     def __str__(self) -> str:
         return f"{self.role}: {self.content[:30]}"
@@ -48,4 +73,9 @@ class ChatAttachment(models.Model):
     byte_size = models.PositiveIntegerField()
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['message', 'created_at'], name='chatatt_msg_created_idx'),
+        ]
+
 # Create your models here.
@@ -1,10 +1,15 @@
-import json
 import logging
 import os
+import threading
+import time
+from collections import deque
+from functools import lru_cache
 from typing import Any
-from copy import deepcopy
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +38,101 @@ WEB_SEARCH_TOOL = {
 MAX_TOOL_CALL_STEPS = 4
 
 
+class _Throttle:
+    # Client-side pacing over a sliding 60s window so bursts wait locally instead of
+    # drawing 429s (and retry backoff) from Moonshot. A limit of 0 disables that check.
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self._events: deque[tuple[float, int]] = deque()
+        self._tokens = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def acquire(self, tokens: int) -> None:
+        self._local.tokens = tokens
+        if not self.rpm and not self.tpm:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._events and now - self._events[0][0] >= 60:
+                    _, spent = self._events.popleft()
+                    self._tokens -= spent
+                within_rpm = not self.rpm or len(self._events) < self.rpm
+                # An empty window always admits, so a single oversized prompt cannot block forever.
+                within_tpm = not self.tpm or not self._events or self._tokens + tokens <= self.tpm
+                if within_rpm and within_tpm:
+                    self._events.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                wait = 60 - (now - self._events[0][0])
+            time.sleep(wait)
+
+    def reacquire(self) -> None:
+        # Adapter retries resend this thread's last request body, so charge the same estimate again.
+        self.acquire(getattr(self._local, "tokens", 0))
+
+
+_THROTTLE = _Throttle(
+    rpm=int(os.getenv("MOONSHOT_RPM", "0")),
+    tpm=int(os.getenv("MOONSHOT_TPM", "0")),
+)
+
+
+class _ThrottledRetry(Retry):
+    # urllib3 replays the POST itself, below _moonshot_request; count each replay against the throttle.
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        _THROTTLE.reacquire()
+        return retry
+
+
+# One pooled session per worker so consecutive chat turns reuse the TCP+TLS
+# connection to Moonshot. Transient failures (connection resets, read timeouts,
+# 429/5xx gateway errors) are retried with jittered exponential backoff, and
+# Retry-After is honoured. Read retries stay at one because each can wait the
+# full MOONSHOT_TIMEOUT.
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=_ThrottledRetry(
+            total=3,
+            connect=2,
+            read=1,
+            backoff_factor=0.3,
+            backoff_jitter=0.3,
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=frozenset({"POST"}),
+            raise_on_status=False,
+        ),
+    ),
+)
+
+
+def _estimate_tokens(messages: list[dict[str, Any]]) -> int:
+    # ~4 characters per token; image parts are billed separately and not counted here.
+    return sum(len(_extract_text_content(message)) for message in messages) // 4
+
+
+# Env vars are fixed for a worker's lifetime; tests call _moonshot_base_config.cache_clear().
+@lru_cache(maxsize=1)
+def _moonshot_base_config() -> dict[str, Any]:
+    api_key = os.getenv("MOONSHOT_API_KEY")
+    base_url = os.getenv("MOONSHOT_API_BASE", "https://api.moonshot.ai/v1")
+    return {
+        "api_key": api_key,
+        "model": os.getenv("MOONSHOT_MODEL"),
+        "url": base_url.rstrip("/") + "/chat/completions",
+        "headers": {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+        "timeout": float(os.getenv("MOONSHOT_TIMEOUT", "60")),
+        "temperature": float(os.getenv("MOONSHOT_TEMPERATURE", "0.2")),
+    }
+
+
 def _extract_text_content(message: dict[str, Any] | None) -> str:
     if not isinstance(message, dict):
         return ""
@@ -60,7 +160,7 @@ def _build_tool_result_messages(tool_calls: list[dict[str, Any]]) -> list[dict[s
         if not tool_call_id:
             continue
         try:
-            arguments = json.loads(arguments_raw) if isinstance(arguments_raw, str) else arguments_raw
+            arguments = orjson.loads(arguments_raw) if isinstance(arguments_raw, str) else arguments_raw
         except Exception:
             arguments = {"raw": str(arguments_raw)}
 
@@ -78,7 +178,7 @@ def _build_tool_result_messages(tool_calls: list[dict[str, Any]]) -> list[dict[s
                 "role": "tool",
                 "tool_call_id": tool_call_id,
                 "name": function_name,
-                "content": json.dumps(tool_result),
+                "content": orjson.dumps(tool_result).decode(),
             }
         )
     return results
@@ -89,40 +189,41 @@ def _moonshot_request(
     model_override: str | None = None,
     enable_web_search: bool = False,
 ) -> str:
-    api_key = os.getenv("MOONSHOT_API_KEY")
-    model = model_override or os.getenv("MOONSHOT_MODEL")
-    base_url = os.getenv("MOONSHOT_API_BASE", "https://api.moonshot.ai/v1")
-    timeout = float(os.getenv("MOONSHOT_TIMEOUT", "60"))
-    temperature = float(os.getenv("MOONSHOT_TEMPERATURE", "0.2"))
+    config = _moonshot_base_config()
+    model = model_override or config["model"]
 
-    if not api_key or not model:
+    if not config["api_key"] or not model:
         return "Moonshot API is not configured. Please set MOONSHOT_API_KEY and MOONSHOT_MODEL."
 
-    url = base_url.rstrip("/") + "/chat/completions"
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     payload = {
         "model": model,
-        "temperature": temperature,
+        "temperature": config["temperature"],
     }
     if enable_web_search:
         payload["tools"] = [WEB_SEARCH_TOOL]
         payload["tool_choice"] = "auto"
-    working_messages = deepcopy(messages)
+    # The loop only appends freshly built dicts, so a shallow copy keeps the caller's list intact.
+    working_messages = list(messages)
     for _ in range(MAX_TOOL_CALL_STEPS):
         payload["messages"] = working_messages
-        response = requests.post(url, headers=headers, json=payload, timeout=timeout)
+        _THROTTLE.acquire(_estimate_tokens(working_messages))
+        response = _SESSION.post(
+            config["url"],
+            headers=config["headers"],
+            data=orjson.dumps(payload),
+            timeout=config["timeout"],
+        )
         if not response.ok:
             detail = response.text
             try:
-                data = response.json()
-                detail = json.dumps(data)
+                detail = orjson.dumps(orjson.loads(response.content)).decode()
             except Exception:
                 pass
             raise requests.HTTPError(
                 f"Moonshot API error {response.status_code}: {detail}",
                 response=response,
             )
-        data = response.json()
+        data = orjson.loads(response.content)
         choice = (data.get("choices") or [{}])[0]
         message = choice.get("message") or {}
         text = _extract_text_content(message)
@@ -149,11 +250,8 @@ def call_moonshot(messages: list[dict[str, Any]]) -> str:
 
 
 def call_moonshot_with_retry(messages: list[dict[str, Any]]) -> str:
-    try:
-        return _moonshot_request(messages)
-    except requests.ReadTimeout:
-        logger.warning("Moonshot timeout, retrying once.")
-        return _moonshot_request(messages)
+    # Retries happen in the session's HTTPAdapter.
+    return _moonshot_request(messages)
 
 
 def call_moonshot_with_tools(
@@ -162,16 +260,8 @@ def call_moonshot_with_tools(
     enable_web_search: bool,
     model_override: str | None = None,
 ) -> str:
-    try:
-        return _moonshot_request(
-            messages,
-            model_override=model_override,
-            enable_web_search=enable_web_search,
-        )
-    except requests.ReadTimeout:
-        logger.warning("Moonshot timeout, retrying once.")
-        return _moonshot_request(
-            messages,
-            model_override=model_override,
-            enable_web_search=enable_web_search,
-        )
+    return _moonshot_request(
+        messages,
+        model_override=model_override,
+        enable_web_search=enable_web_search,
+    )
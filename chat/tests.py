@@ -1,19 +1,34 @@
+import shutil
+import tempfile
 from io import BytesIO
 from unittest.mock import Mock, patch
 
+import orjson
 import requests
 from PIL import Image
 from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.urls import reverse
+from urllib3.exceptions import ProtocolError
 
-from . import services
-from .models import ChatMessage
+from . import services, views
+from .models import ChatAttachment, ChatMessage, ChatSession
 
+# Image uploads are written to disk; keep them out of the project's media/ directory.
+TEST_MEDIA_ROOT = tempfile.mkdtemp(prefix="axiom-test-media-")
 
+
+def tearDownModule():
+    shutil.rmtree(TEST_MEDIA_ROOT, ignore_errors=True)
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
 class ChatSendViewTests(TestCase):
     def setUp(self):
+        views._env_flag.cache_clear()
+        self.addCleanup(views._env_flag.cache_clear)
         self.user = User.objects.create_user(username="alice", password="pw12345pass")
         self.client.force_login(self.user)
         self.url = reverse("chat_send")
@@ -34,13 +49,26 @@ class ChatSendViewTests(TestCase):
         self.assertTrue(mock_tools.call_args.kwargs["enable_web_search"])
         self.assertEqual(mock_tools.call_args.kwargs["model_override"], "moonshot-v1-auto")
 
+    def test_json_body_is_accepted(self):
+        with patch("chat.views.call_moonshot_with_tools", return_value="json answer"):
+            response = self.client.post(
+                self.url,
+                data=orjson.dumps({"message": "Explain B-tree indexes"}),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(response.json()["assistant_message"], "json answer")
+
     def test_search_model_override_is_respected(self):
-        with patch.dict("os.environ", {"MOONSHOT_ENABLE_WEB_SEARCH": "true", "MOONSHOT_SEARCH_MODEL": "moonshot-v1-auto"}):
-            with patch("chat.views.call_moonshot_with_tools", return_value="ok") as mock_tools:
-                response = self.client.post(self.url, {"message": "What changed in Python?"})
+        with patch.dict("os.environ", {"MOONSHOT_ENABLE_WEB_SEARCH": "true"}):
+            with patch("chat.views.SEARCH_MODEL", "kimi-search-test"):
+                with patch("chat.views.call_moonshot_with_tools", return_value="ok") as mock_tools:
+                    response = self.client.post(self.url, {"message": "What changed in Python?"})
 
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(mock_tools.call_args.kwargs["model_override"], "moonshot-v1-auto")
+        self.assertEqual(mock_tools.call_args.kwargs["model_override"], "kimi-search-test")
         self.assertTrue(mock_tools.call_args.kwargs["enable_web_search"])
 
     def test_web_search_can_be_disabled(self):
@@ -60,6 +88,26 @@ class ChatSendViewTests(TestCase):
         payload = response.json()
         self.assertIn("slow or unavailable", payload["assistant_message"])
 
+    def test_untitled_session_gets_title_and_fresh_timestamp(self):
+        session = ChatSession.objects.create(user=self.user)
+        before = session.updated_at
+
+        with patch("chat.views.call_moonshot_with_tools", return_value="ok"):
+            response = self.client.post(self.url, {"message": "Compare SQLite and Postgres", "session_id": str(session.id)})
+
+        self.assertEqual(response.status_code, 200)
+        session.refresh_from_db()
+        self.assertEqual(session.title, "Compare SQLite and Postgres")
+        self.assertGreater(session.updated_at, before)
+
+    def test_new_session_is_not_updated_before_it_was_created(self):
+        with patch("chat.views.call_moonshot_with_tools", return_value="ok"):
+            response = self.client.post(self.url, {"message": "Compare SQLite and Postgres"})
+
+        self.assertEqual(response.status_code, 200)
+        session = ChatSession.objects.get(user=self.user)
+        self.assertGreaterEqual(session.updated_at, session.created_at)
+
     def test_image_prompt_uses_retry_path_without_tool_calling(self):
         image = Image.new("RGB", (16, 16), (120, 30, 200))
         image_bytes = BytesIO()
@@ -75,8 +123,196 @@ class ChatSendViewTests(TestCase):
         self.assertEqual(mock_retry.call_count, 2)
         mock_tools.assert_not_called()
 
+    def test_invalid_image_is_rejected_before_any_write(self):
+        bogus = SimpleUploadedFile("fake.png", b"not an image", content_type="image/png")
+
+        response = self.client.post(self.url, {"message": "What is this?", "image": bogus})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ChatSession.objects.exists())
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_image_with_descriptive_prompt_skips_vision_summary(self):
+        image = Image.new("RGB", (16, 16), (120, 30, 200))
+        image_bytes = BytesIO()
+        image.save(image_bytes, format="PNG")
+        image_file = SimpleUploadedFile("sample.png", image_bytes.getvalue(), content_type="image/png")
+
+        with patch("chat.views.call_moonshot_with_retry", return_value="Chart answer") as mock_retry:
+            response = self.client.post(
+                self.url,
+                {"message": "Summarize the quarterly revenue trend in this chart.", "image": image_file},
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["assistant_message"], "Chart answer")
+        mock_retry.assert_called_once()
+
+
+class QueryHelpersTests(TestCase):
+    def test_normalize_query_matches_isalnum_for_ascii_and_unicode(self):
+        self.assertEqual(views._normalize_query("  What's NEW in Django_6?! "), "what s new in django 6")
+        self.assertEqual(views._normalize_query("Café—naïve 東京。ニュース"), "café naïve 東京 ニュース")
+
+    def test_strip_sources_block_is_case_insensitive(self):
+        self.assertEqual(views._strip_sources_block("Answer text.\n\nSOURCES:\n- a"), "Answer text.")
+        self.assertEqual(views._strip_sources_block("No marker here."), "No marker here.")
+
+    def test_requires_mandatory_search(self):
+        for query in ("Who is the CEO of Nvidia", "newest iPhone?", "events in 1999", "which python version is stable"):
+            self.assertTrue(views._requires_mandatory_search(views._normalize_query(query)), query)
+        for query in ("Write a haiku about autumn", "Explain B-tree indexes", "population of 12345"):
+            self.assertFalse(views._requires_mandatory_search(views._normalize_query(query)), query)
+
+
+class SidebarTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="carol", password="pw12345pass")
+        self.client.force_login(self.user)
+
+    def test_sidebar_lists_session_created_by_chat_send(self):
+        response = self.client.get(reverse("chat_home"))
+        self.assertContains(response, "No sessions yet.")
+
+        self.client.post(reverse("chat_send"), {"message": "hello"})
+
+        response = self.client.get(reverse("chat_home"), {"resume": "1"})
+        session = ChatSession.objects.get(user=self.user)
+        self.assertNotContains(response, "No sessions yet.")
+        self.assertEqual(response.context["active_session"], session)
+        self.assertEqual(response.context["sessions"][0].title, "hello")
+
+
+class CompressImageTests(TestCase):
+    def test_large_jpeg_is_downscaled_to_max_edge(self):
+        image = Image.new("RGB", (4000, 3000), (10, 200, 30))
+        image_bytes = BytesIO()
+        image.save(image_bytes, format="JPEG")
+        upload = SimpleUploadedFile("big.jpg", image_bytes.getvalue(), content_type="image/jpeg")
+
+        data, width, height, byte_size = views._compress_image(upload)
+
+        self.assertEqual((width, height), (views.MAX_IMAGE_EDGE, 768))
+        self.assertEqual(byte_size, len(data))
+        self.assertEqual(Image.open(BytesIO(data)).format, "WEBP")
+
+    def test_small_webp_is_stored_without_reencoding(self):
+        image = Image.new("RGB", (64, 48), (10, 200, 30))
+        image_bytes = BytesIO()
+        image.save(image_bytes, format="WEBP")
+        upload = SimpleUploadedFile("small.webp", image_bytes.getvalue(), content_type="image/webp")
+
+        data, width, height, byte_size = views._compress_image(upload)
+
+        self.assertEqual(data, image_bytes.getvalue())
+        self.assertEqual((width, height, byte_size), (64, 48, len(data)))
+
+    def test_webp_with_trailing_data_is_reencoded(self):
+        image = Image.new("RGB", (64, 48), (10, 200, 30))
+        image_bytes = BytesIO()
+        image.save(image_bytes, format="WEBP")
+        payload = image_bytes.getvalue() + b"<html><script>alert(1)</script></html>"
+        upload = SimpleUploadedFile("trailing.webp", payload, content_type="image/webp")
+
+        data, width, height, byte_size = views._compress_image(upload)
+
+        self.assertNotIn(b"<script>", data)
+        self.assertEqual(Image.open(BytesIO(data)).format, "WEBP")
+        self.assertEqual((width, height, byte_size), (64, 48, len(data)))
+
+    def test_webp_with_unknown_chunk_is_reencoded(self):
+        image = Image.new("RGB", (64, 48), (10, 200, 30))
+        image_bytes = BytesIO()
+        image.save(image_bytes, format="WEBP")
+        junk = b"<html><script>alert(1)</script></html>"
+        body = image_bytes.getvalue()[12:] + b"JUNK" + len(junk).to_bytes(4, "little") + junk
+        payload = b"RIFF" + (len(body) + 4).to_bytes(4, "little") + b"WEBP" + body
+        self.assertEqual(Image.open(BytesIO(payload)).size, (64, 48))
+        upload = SimpleUploadedFile("junk.webp", payload, content_type="image/webp")
+
+        data, width, height, byte_size = views._compress_image(upload)
+
+        self.assertNotIn(b"<script>", data)
+        self.assertEqual((width, height, byte_size), (64, 48, len(data)))
+
+    def test_webp_with_exif_is_reencoded_without_metadata(self):
+        image = Image.new("RGB", (64, 48), (10, 200, 30))
+        exif = Image.Exif()
+        exif[0x010F] = "CameraMaker"
+        exif[0x0110] = "CameraModel"
+        image_bytes = BytesIO()
+        image.save(image_bytes, format="WEBP", exif=exif)
+        self.assertIn("exif", Image.open(BytesIO(image_bytes.getvalue())).info)
+        upload = SimpleUploadedFile("tagged.webp", image_bytes.getvalue(), content_type="image/webp")
+
+        data, width, height, byte_size = views._compress_image(upload)
+
+        self.assertNotEqual(data, image_bytes.getvalue())
+        self.assertNotIn("exif", Image.open(BytesIO(data)).info)
+        self.assertNotIn(b"CameraMaker", data)
+        self.assertEqual((width, height, byte_size), (64, 48, len(data)))
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT)
+class ChatMessagesPartialTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="bob", password="pw12345pass")
+        self.client.force_login(self.user)
+        self.session = ChatSession.objects.create(user=self.user, title="t")
+
+    def test_attachments_are_prefetched(self):
+        for index in range(3):
+            message = ChatMessage.objects.create(session=self.session, role="user", content=f"m{index}")
+            ChatAttachment.objects.create(
+                message=message,
+                image=ContentFile(b"webp", name="upload.webp"),
+                image_width=1,
+                image_height=1,
+                byte_size=4,
+            )
+        ChatMessage.objects.create(session=self.session, role="assistant", content="done")
+        url = reverse("chat_messages_partial", args=[self.session.id])
+
+        # Auth session + user, then owned messages, attachments.
+        with self.assertNumQueries(4):
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        messages = response.json()["messages"]
+        self.assertEqual([m["content"] for m in messages], ["m0", "m1", "m2", "done"])
+        self.assertEqual([len(m["attachments"]) for m in messages], [1, 1, 1, 0])
+
+    def test_empty_session_returns_no_messages(self):
+        response = self.client.get(reverse("chat_messages_partial", args=[self.session.id]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"messages": []})
+
+    def test_trailing_user_message_reports_pending_reply(self):
+        user_message = ChatMessage.objects.create(session=self.session, role="user", content="still thinking?")
+
+        response = self.client.get(reverse("chat_messages_partial", args=[self.session.id]))
+
+        messages = response.json()["messages"]
+        self.assertEqual([m["status"] for m in messages], ["complete", "pending"])
+        self.assertEqual(messages[-1]["id"], f"pending-{user_message.id}")
+        self.assertEqual(messages[-1]["role"], "assistant")
+
+    def test_other_users_session_is_not_found(self):
+        other = User.objects.create_user(username="mallory", password="pw12345pass")
+        other_session = ChatSession.objects.create(user=other)
+        ChatMessage.objects.create(session=other_session, role="user", content="secret")
+
+        response = self.client.get(reverse("chat_messages_partial", args=[other_session.id]))
+
+        self.assertEqual(response.status_code, 404)
+
 
 class ServicesTests(TestCase):
+    def setUp(self):
+        services._moonshot_base_config.cache_clear()
+        self.addCleanup(services._moonshot_base_config.cache_clear)
+
     def test_services_no_longer_exposes_mcp_helpers(self):
         self.assertFalse(hasattr(services, "mcp_search"))
         self.assertFalse(hasattr(services, "build_context_block"))
@@ -84,13 +320,13 @@ class ServicesTests(TestCase):
     def test_call_moonshot_with_tools_sends_web_search_payload(self):
         mock_response = Mock()
         mock_response.ok = True
-        mock_response.json.return_value = {"choices": [{"message": {"content": "done"}}]}
+        mock_response.content = orjson.dumps({"choices": [{"message": {"content": "done"}}]})
 
         with patch.dict(
             "os.environ",
             {"MOONSHOT_API_KEY": "k", "MOONSHOT_MODEL": "kimi-k2.5", "MOONSHOT_API_BASE": "https://api.moonshot.ai/v1"},
         ):
-            with patch("chat.services.requests.post", return_value=mock_response) as mock_post:
+            with patch("chat.services._SESSION.post", return_value=mock_response) as mock_post:
                 result = services.call_moonshot_with_tools(
                     [{"role": "user", "content": "latest news"}],
                     enable_web_search=True,
@@ -98,30 +334,59 @@ class ServicesTests(TestCase):
                 )
 
         self.assertEqual(result, "done")
-        payload = mock_post.call_args.kwargs["json"]
+        payload = orjson.loads(mock_post.call_args.kwargs["data"])
         self.assertEqual(payload["model"], "moonshot-v1-auto")
         self.assertEqual(payload["tool_choice"], "auto")
         self.assertEqual(payload["tools"][0]["function"]["name"], "$web_search")
 
-    def test_call_moonshot_with_tools_retries_on_timeout(self):
-        ok_response = Mock()
-        ok_response.ok = True
-        ok_response.json.return_value = {"choices": [{"message": {"content": "retry success"}}]}
+    def test_session_retries_transient_failures_with_backoff(self):
+        retries = services._SESSION.get_adapter("https://api.moonshot.ai/v1").max_retries
+
+        self.assertIn("POST", retries.allowed_methods)
+        self.assertEqual(set(retries.status_forcelist), {429, 502, 503, 504})
+        self.assertGreater(retries.backoff_factor, 0)
+        self.assertGreater(retries.backoff_jitter, 0)
+
+    def test_throttle_waits_for_window_when_rpm_is_exhausted(self):
+        throttle = services._Throttle(rpm=2, tpm=0)
+        clock = [100.0]
+
+        def fake_sleep(seconds):
+            clock[0] += seconds
+
+        with patch("chat.services.time.monotonic", side_effect=lambda: clock[0]):
+            with patch("chat.services.time.sleep", side_effect=fake_sleep) as mock_sleep:
+                throttle.acquire(10)
+                throttle.acquire(10)
+                throttle.acquire(10)
+
+        mock_sleep.assert_called_once_with(60.0)
+        self.assertEqual(clock[0], 160.0)
+
+    def test_adapter_retries_are_charged_to_the_throttle(self):
+        throttle = services._Throttle(rpm=10, tpm=0)
+        retries = services._SESSION.get_adapter("https://api.moonshot.ai/v1").max_retries
 
+        with patch("chat.services._THROTTLE", throttle):
+            throttle.acquire(7)
+            retries.increment("POST", "/v1/chat/completions", error=ProtocolError())
+
+        self.assertEqual([tokens for _, tokens in throttle._events], [7, 7])
+
+    def test_service_layer_has_no_manual_retry(self):
+        # _SESSION.post is mocked, so this covers only the service loop; adapter retries are configured separately.
         with patch.dict("os.environ", {"MOONSHOT_API_KEY": "k", "MOONSHOT_MODEL": "kimi-k2.5"}):
-            with patch("chat.services.requests.post", side_effect=[requests.ReadTimeout(), ok_response]) as mock_post:
-                result = services.call_moonshot_with_tools(
-                    [{"role": "user", "content": "search me"}],
-                    enable_web_search=True,
-                )
+            with patch("chat.services._SESSION.post", side_effect=requests.ReadTimeout()) as mock_post:
+                with self.assertRaises(requests.ReadTimeout):
+                    services.call_moonshot_with_tools(
+                        [{"role": "user", "content": "search me"}],
+                        enable_web_search=True,
+                    )
 
-        self.assertEqual(result, "retry success")
-        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(mock_post.call_count, 1)
 
     def test_call_moonshot_with_tools_continues_after_tool_calls(self):
-        first = Mock()
-        first.ok = True
-        first.json.return_value = {
+        first_body = {
             "choices": [
                 {
                     "finish_reason": "tool_calls",
@@ -141,9 +406,7 @@ class ServicesTests(TestCase):
                 }
             ]
         }
-        second = Mock()
-        second.ok = True
-        second.json.return_value = {
+        second_body = {
             "choices": [
                 {
                     "finish_reason": "stop",
@@ -154,19 +417,25 @@ class ServicesTests(TestCase):
                 }
             ]
         }
+        first = Mock()
+        first.ok = True
+        first.content = orjson.dumps(first_body)
+        second = Mock()
+        second.ok = True
+        second.content = orjson.dumps(second_body)
+
+        messages = [{"role": "user", "content": "latest python version"}]
 
         with patch.dict("os.environ", {"MOONSHOT_API_KEY": "k", "MOONSHOT_MODEL": "kimi-k2.5"}):
-            with patch("chat.services.requests.post", side_effect=[first, second]) as mock_post:
-                result = services.call_moonshot_with_tools(
-                    [{"role": "user", "content": "latest python version"}],
-                    enable_web_search=True,
-                )
+            with patch("chat.services._SESSION.post", side_effect=[first, second]) as mock_post:
+                result = services.call_moonshot_with_tools(messages, enable_web_search=True)
 
         self.assertEqual(result, "Python latest is ...")
+        self.assertEqual(len(messages), 1)
         self.assertEqual(mock_post.call_count, 2)
-        second_payload = mock_post.call_args_list[1].kwargs["json"]
+        second_payload = orjson.loads(mock_post.call_args_list[1].kwargs["data"])
         tool_messages = [m for m in second_payload["messages"] if m.get("role") == "tool"]
         self.assertEqual(len(tool_messages), 1)
         self.assertEqual(tool_messages[0]["tool_call_id"], "call_1")
         self.assertEqual(tool_messages[0]["name"], "$web_search")
-        self.assertEqual(tool_messages[0]["content"], "{\"query\": \"latest python version\"}")
+        self.assertEqual(tool_messages[0]["content"], "{\"query\":\"latest python version\"}")
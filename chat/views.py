@@ -1,17 +1,21 @@
 import base64
-import json
 import logging
 import os
 import re
+from collections import defaultdict
+from functools import lru_cache
 from io import BytesIO
 
+import orjson
 from django.contrib.auth import login
 from django.contrib.auth.decorators import login_required
 from django.core.files.base import ContentFile
-from django.http import JsonResponse
+from django.db import transaction
+from django.http import Http404, HttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 from django.views.decorators.http import require_GET, require_POST
+from PIL import Image
 from .forms import SignupForm
 from .models import ChatAttachment, ChatMessage, ChatSession
 from .services import SYSTEM_PROMPT, call_moonshot_with_retry, call_moonshot_with_tools
@@ -20,9 +24,12 @@ logger = logging.getLogger(__name__)
 
 MAX_IMAGE_BYTES = 4 * 1024 * 1024
 MAX_IMAGE_EDGE = 1024
+WEBP_PASSTHROUGH_CHUNKS = frozenset({b"VP8 ", b"VP8L", b"VP8X", b"ALPH", b"ICCP"})
 MAX_HISTORY = 8
-SMALLTALK_SET = {"hi", "hello", "hey", "yo", "sup", "hola"}
-MANDATORY_SEARCH_KEYWORDS = {
+IMAGE_SUMMARY_PROMPT_CHARS = 20
+SEARCH_MODEL = os.getenv("MOONSHOT_SEARCH_MODEL", "moonshot-v1-auto")
+SMALLTALK_SET = frozenset({"hi", "hello", "hey", "yo", "sup", "hola"})
+MANDATORY_SEARCH_KEYWORDS = frozenset({
     "latest",
     "current",
     "today",
@@ -40,24 +47,40 @@ MANDATORY_SEARCH_KEYWORDS = {
     "regulation",
     "news",
     "update",
-}
+})
+_MODEL_INTENTS = frozenset({
+    "what model are you",
+    "which model are you",
+    "what model are you running",
+    "what model do you use",
+    "who built you",
+    "who made you",
+    "who created you",
+    "who are you",
+    "are you openai",
+})
+_MODEL_INTENT_PREFIXES = ("what model", "who built")
+# Same split as str.isalnum(): \w minus underscore.
+_NON_ALNUM_RE = re.compile(r"[\W_]+")
+_ASCII_SEPARATORS = str.maketrans({chr(code): " " for code in range(128) if not chr(code).isalnum()})
+_RE_SOURCES_MARKER = re.compile(r"sources:", re.IGNORECASE)
+# One pass for the recency words, years, and "what/which ... version/release" phrasing.
+_RE_MANDATORY_SEARCH = re.compile(
+    r"\b(?:latest|current|newest|202[0-9]|19[0-9]{2})\b"
+    r"|\b(?:what|which)\s+.*\b(?:version|release)\b"
+)
+
+
+class OrjsonResponse(HttpResponse):
+    def __init__(self, data, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(orjson.dumps(data), **kwargs)
 
 
 def _static_response_for_query(normalized: str) -> str | None:
     if not normalized:
         return None
-    model_intents = {
-        "what model are you",
-        "which model are you",
-        "what model are you running",
-        "what model do you use",
-        "who built you",
-        "who made you",
-        "who created you",
-        "who are you",
-        "are you openai",
-    }
-    if normalized in model_intents or normalized.startswith("what model") or normalized.startswith("who built"):
+    if normalized in _MODEL_INTENTS or normalized.startswith(_MODEL_INTENT_PREFIXES):
         return (
             "I'm Axiom, an AI research assistant. "
             "I don't disclose underlying model or provider details. "
@@ -69,18 +92,22 @@ def _static_response_for_query(normalized: str) -> str | None:
 
 
 def _strip_sources_block(text: str) -> str:
-    lowered = text.lower()
-    marker = lowered.find("sources:")
-    if marker == -1:
+    match = _RE_SOURCES_MARKER.search(text)
+    if match is None:
         return text
-    return text[:marker].rstrip()
+    return text[:match.start()].rstrip()
 
 
 def _normalize_query(text: str) -> str:
-    cleaned = "".join(ch if ch.isalnum() else " " for ch in text.lower())
-    return " ".join(cleaned.split())
+    lowered = text.lower()
+    if lowered.isascii():
+        return " ".join(lowered.translate(_ASCII_SEPARATORS).split())
+    # The table only covers ASCII; other scripts need the Unicode-aware regex.
+    return _NON_ALNUM_RE.sub(" ", lowered).strip()
 
 
+# Cached per (name, default). SEARCH_MODEL is read at import instead, so tests patch that constant directly.
+@lru_cache(maxsize=64)
 def _env_flag(name: str, default: bool) -> bool:
     raw = os.getenv(name)
     if raw is None:
@@ -88,9 +115,15 @@ def _env_flag(name: str, default: bool) -> bool:
     return raw.strip().lower() in {"1", "true", "yes", "on"}
 
 
-def _research_policy_prompt() -> str:
-    today = timezone.now().date().isoformat()
-    knowledge_cutoff = os.getenv("MOONSHOT_KNOWLEDGE_CUTOFF", "unknown")
+def _research_policy_prompt(now) -> str:
+    return _build_research_policy_prompt(
+        now.date().isoformat(),
+        os.getenv("MOONSHOT_KNOWLEDGE_CUTOFF", "unknown"),
+    )
+
+
+@lru_cache(maxsize=2)
+def _build_research_policy_prompt(today: str, knowledge_cutoff: str) -> str:
     return (
         f"Runtime date: {today}. "
         f"Model knowledge cutoff may be {knowledge_cutoff}. "
@@ -99,42 +132,73 @@ def _research_policy_prompt() -> str:
     )
 
 
-def _requires_mandatory_search(query: str) -> bool:
-    normalized = _normalize_query(query)
+def _requires_mandatory_search(normalized: str) -> bool:
     tokens = set(normalized.split())
     if tokens.intersection(MANDATORY_SEARCH_KEYWORDS):
         return True
-    if re.search(r"\b(what|which)\s+.*\b(version|release)\b", normalized):
-        return True
-    if re.search(r"\b(latest|current|newest)\b", normalized):
-        return True
-    if re.search(r"\b(202[0-9]|19[0-9]{2})\b", normalized):
-        return True
-    return False
+    return _RE_MANDATORY_SEARCH.search(normalized) is not None
 
 
-def _compress_image(uploaded_file):
-    from PIL import Image
+def _needs_image_summary(message_text: str) -> bool:
+    # A substantive, non-question prompt already frames the image; skip the extra vision round trip.
+    return len(message_text) < IMAGE_SUMMARY_PROMPT_CHARS or message_text.endswith("?")
+
+
+def _is_plain_webp(data: bytes) -> bool:
+    # The RIFF size must cover the file exactly (no trailing bytes) and every chunk must be image data.
+    if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WEBP":
+        return False
+    if int.from_bytes(data[4:8], "little") + 8 != len(data):
+        return False
+    offset = 12
+    while offset < len(data):
+        if offset + 8 > len(data) or data[offset:offset + 4] not in WEBP_PASSTHROUGH_CHUNKS:
+            return False
+        size = int.from_bytes(data[offset + 4:offset + 8], "little")
+        # Chunk payloads are padded to an even length.
+        offset += 8 + size + (size & 1)
+    return offset == len(data)
+
 
+def _compress_image(uploaded_file):
     if uploaded_file.size > MAX_IMAGE_BYTES:
         raise ValueError("Image is too large (max 4MB).")
 
     try:
         image = Image.open(uploaded_file)
+        # JPEGs can decode at a reduced DCT scale; keep 2x headroom like thumbnail()'s reducing_gap.
+        image.draft(None, (MAX_IMAGE_EDGE * 2, MAX_IMAGE_EDGE * 2))
         image.load()
     except Exception as exc:
         raise ValueError("Invalid image file.") from exc
 
+    # Already a static WebP within bounds: store the upload as-is, but only if its RIFF container
+    # holds nothing beyond image data. Anything else is re-encoded so no client bytes survive.
+    if image.format == "WEBP" and not getattr(image, "is_animated", False) and max(image.size) <= MAX_IMAGE_EDGE:
+        uploaded_file.seek(0)
+        data = uploaded_file.read()
+        if _is_plain_webp(data):
+            return data, image.width, image.height, len(data)
+
     if image.mode not in ("RGB", "RGBA"):
         image = image.convert("RGB")
 
-    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+    image.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.Resampling.BILINEAR)
     buffer = BytesIO()
-    image.save(buffer, format="WEBP", quality=80, method=6)
+    image.save(buffer, format="WEBP", quality=80, method=4)
     data = buffer.getvalue()
     return data, image.width, image.height, len(data)
 
 
+def _finalize_session(session, title: str = "") -> None:
+    # Single UPDATE per request; QuerySet.update() skips auto_now, so stamp updated_at here.
+    # Take a fresh timestamp: a session created during this request has created_at after the view's entry time.
+    fields = {"updated_at": timezone.now()}
+    if title:
+        fields["title"] = title
+    ChatSession.objects.filter(pk=session.pk).update(**fields)
+
+
 def _get_sidebar_sessions(user):
     return ChatSession.objects.filter(user=user).order_by("-updated_at")[:25]
 
@@ -144,9 +208,9 @@ def index(request):
     sessions = _get_sidebar_sessions(request.user)
     start_new = request.GET.get("new") == "1"
     active_session = None
-    if not start_new and request.GET.get("resume") == "1":
-        active_session = sessions[0] if sessions else None
-    messages = active_session.messages.all() if active_session else []
+    if not start_new and request.GET.get("resume") == "1" and sessions:
+        active_session = sessions[0]
+    messages = active_session.messages.with_attachments() if active_session else []
     return render(
         request,
         "chat/index.html",
@@ -161,7 +225,7 @@ def index(request):
 
 @login_required
 def session_view(request, session_id):
-    session = get_object_or_404(ChatSession, id=session_id, user=request.user)
+    session = get_object_or_404(ChatSession.objects.with_messages(), id=session_id, user=request.user)
     sessions = _get_sidebar_sessions(request.user)
     messages = session.messages.all()
     return render(
@@ -178,27 +242,54 @@ def session_view(request, session_id):
 @login_required
 @require_GET
 def chat_messages_partial(request, session_id):
-    session = get_object_or_404(ChatSession, id=session_id, user=request.user)
-    messages = session.messages.all()
+    # Ownership is enforced by the session__user join; only an empty result needs a separate check.
+    messages = list(
+        ChatMessage.objects.filter(session_id=session_id, session__user=request.user)
+        .values("id", "role", "content")
+    )
+    if not messages:
+        if not ChatSession.objects.filter(id=session_id, user=request.user).exists():
+            raise Http404("No ChatSession matches the given query.")
+        return OrjsonResponse({"messages": []})
+
+    # Plain rows instead of model instances: one query for all attachments in the session.
+    image_storage = ChatAttachment._meta.get_field("image").storage
+    attachments_by_message = defaultdict(list)
+    attachment_rows = (
+        ChatAttachment.objects.filter(message__session_id=session_id)
+        .order_by("id")
+        .values_list("message_id", "image")
+    )
+    for message_id, image_name in attachment_rows:
+        attachments_by_message[message_id].append({"url": image_storage.url(image_name)})
+
     payload = []
     for message in messages:
-        attachments = [
-            {"url": attachment.image.url}
-            for attachment in message.attachments.all()
-        ]
         status = "complete"
-        if message.role == "assistant" and not message.content:
+        if message["role"] == "assistant" and not message["content"]:
             status = "pending"
         payload.append(
             {
-                "id": str(message.id),
-                "role": message.role,
-                "content": message.content,
+                "id": str(message["id"]),
+                "role": message["role"],
+                "content": message["content"],
                 "status": status,
-                "attachments": attachments,
+                "attachments": attachments_by_message.get(message["id"], []),
+            }
+        )
+    # chat_send stores the assistant reply only once it is final, so a trailing user message means a
+    # reply is still in flight. Report it as pending so a reloaded page keeps polling for it.
+    if messages[-1]["role"] == "user":
+        payload.append(
+            {
+                "id": f"pending-{messages[-1]['id']}",
+                "role": "assistant",
+                "content": "",
+                "status": "pending",
+                "attachments": [],
             }
         )
-    return JsonResponse({"messages": payload})
+    return OrjsonResponse({"messages": payload})
 
 
 def signup_view(request):
@@ -216,61 +307,67 @@ def signup_view(request):
 @login_required
 @require_POST
 def chat_send(request):
+    now = timezone.now()
     if request.content_type and request.content_type.startswith("multipart/"):
         message_text = (request.POST.get("message") or "").strip()
         session_id = request.POST.get("session_id") or None
         upload = request.FILES.get("image")
     else:
-        data = json.loads(request.body or "{}")
+        data = orjson.loads(request.body or b"{}")
         message_text = (data.get("message") or "").strip()
         session_id = data.get("session_id") or None
         upload = None
 
     if not message_text and not upload:
-        return JsonResponse({"error": "Message cannot be empty."}, status=400)
+        return OrjsonResponse({"error": "Message cannot be empty."}, status=400)
 
-    if session_id:
-        session = get_object_or_404(ChatSession, id=session_id, user=request.user)
-    else:
-        session = ChatSession.objects.create(user=request.user)
-
-    user_message = ChatMessage.objects.create(session=session, role="user", content=message_text)
-
-    if not session.title:
-        session.title = message_text[:60]
-    session.updated_at = timezone.now()
-    session.save(update_fields=["title", "updated_at"])
+    session = get_object_or_404(ChatSession, id=session_id, user=request.user) if session_id else None
 
+    # Validate and encode the upload before writing anything, so a bad image leaves no rows behind.
     image_payload = None
     if upload:
         try:
             data, width, height, byte_size = _compress_image(upload)
-            attachment = ChatAttachment.objects.create(
+        except ValueError as exc:
+            return OrjsonResponse({"error": str(exc)}, status=400)
+        # Encode once; both the vision and answer prompts reference the same string.
+        image_payload = {
+            "url": "data:image/webp;base64," + base64.b64encode(data).decode("ascii"),
+        }
+
+    normalized = _normalize_query(message_text)
+    canned_reply = None
+    if not upload:
+        if normalized in SMALLTALK_SET or len(normalized) <= 2:
+            canned_reply = "Hello! Ask me anything you want to research."
+        else:
+            canned_reply = _static_response_for_query(normalized)
+
+    with transaction.atomic():
+        if session is None:
+            session = ChatSession.objects.create(user=request.user, title=message_text[:60])
+            pending_title = ""
+        else:
+            pending_title = "" if session.title else message_text[:60]
+        user_message = ChatMessage.objects.create(session=session, role="user", content=message_text)
+        if upload:
+            ChatAttachment.objects.create(
                 message=user_message,
                 image=ContentFile(data, name="upload.webp"),
                 image_width=width,
                 image_height=height,
                 byte_size=byte_size,
             )
-            attachment.save()
-            image_payload = {
-                "mime": "image/webp",
-                "data": base64.b64encode(data).decode("ascii"),
-            }
-        except ValueError as exc:
-            return JsonResponse({"error": str(exc)}, status=400)
+        if canned_reply:
+            assistant_message = ChatMessage.objects.create(
+                session=session,
+                role="assistant",
+                content=canned_reply,
+            )
+            _finalize_session(session, pending_title)
 
-    normalized = _normalize_query(message_text)
-    if not upload and (normalized in SMALLTALK_SET or len(normalized) <= 2):
-        assistant_text = "Hello! Ask me anything you want to research."
-        assistant_message = ChatMessage.objects.create(
-            session=session,
-            role="assistant",
-            content=assistant_text,
-        )
-        session.updated_at = timezone.now()
-        session.save(update_fields=["updated_at"])
-        return JsonResponse(
+    if canned_reply:
+        return OrjsonResponse(
             {
                 "session_id": str(session.id),
                 "assistant_message": assistant_message.content,
@@ -278,32 +375,8 @@ def chat_send(request):
             }
         )
 
-    if not upload:
-        static_response = _static_response_for_query(normalized)
-        if static_response:
-            assistant_message = ChatMessage.objects.create(
-                session=session,
-                role="assistant",
-                content=static_response,
-            )
-            session.updated_at = timezone.now()
-            session.save(update_fields=["updated_at"])
-            return JsonResponse(
-                {
-                    "session_id": str(session.id),
-                    "assistant_message": assistant_message.content,
-                    "sources": [],
-                }
-            )
-
-    assistant_message = ChatMessage.objects.create(
-        session=session,
-        role="assistant",
-        content="",
-    )
-
     image_description = ""
-    if image_payload:
+    if image_payload and _needs_image_summary(message_text):
         try:
             vision_messages = [
                 {"role": "system", "content": "You are a vision assistant. Describe the image content concisely."},
@@ -313,7 +386,7 @@ def chat_send(request):
                         {"type": "text", "text": message_text or "Describe the image."},
                         {
                             "type": "image_url",
-                            "image_url": {"url": f"data:{image_payload['mime']};base64,{image_payload['data']}"},
+                            "image_url": {"url": image_payload["url"]},
                         },
                     ],
                 },
@@ -325,12 +398,14 @@ def chat_send(request):
 
     recent_messages = (
         ChatMessage.objects.filter(session=session)
-        .order_by("-created_at")[:MAX_HISTORY]
+        .exclude(role="assistant", content="")
+        .order_by("-created_at")
+        .values("role", "content")[:MAX_HISTORY]
     )
     history = list(reversed(recent_messages))
     prompt_messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "system", "content": _research_policy_prompt()},
+        {"role": "system", "content": _research_policy_prompt(now)},
     ]
     if image_payload:
         content = []
@@ -344,22 +419,20 @@ def chat_send(request):
         content.append(
             {
                 "type": "image_url",
-                "image_url": {"url": f"data:{image_payload['mime']};base64,{image_payload['data']}"},
+                "image_url": {"url": image_payload["url"]},
             }
         )
         prompt_messages.append({"role": "user", "content": content})
     else:
-        for msg in history:
-            if msg.role == "assistant" and not msg.content:
-                continue
-            prompt_messages.append({"role": msg.role, "content": msg.content})
+        # values() rows already have the {"role", "content"} shape the API expects.
+        prompt_messages.extend(history)
 
     try:
         if image_payload:
             assistant_text = call_moonshot_with_retry(prompt_messages)
         else:
             search_enabled = _env_flag("MOONSHOT_ENABLE_WEB_SEARCH", default=True)
-            if search_enabled and _requires_mandatory_search(message_text):
+            if search_enabled and _requires_mandatory_search(normalized):
                 prompt_messages.insert(
                     2,
                     {
@@ -370,7 +443,7 @@ def chat_send(request):
                         ),
                     },
                 )
-            search_model = os.getenv("MOONSHOT_SEARCH_MODEL", "moonshot-v1-auto") if search_enabled else None
+            search_model = SEARCH_MODEL if search_enabled else None
             assistant_text = call_moonshot_with_tools(
                 prompt_messages,
                 enable_web_search=search_enabled,
@@ -387,12 +460,15 @@ def chat_send(request):
 
     # Sources display temporarily disabled
 
-    assistant_message.content = assistant_text
-    assistant_message.save(update_fields=["content"])
-    session.updated_at = timezone.now()
-    session.save(update_fields=["updated_at"])
+    with transaction.atomic():
+        assistant_message = ChatMessage.objects.create(
+            session=session,
+            role="assistant",
+            content=assistant_text,
+        )
+        _finalize_session(session, pending_title)
 
-    return JsonResponse(
+    return OrjsonResponse(
         {
             "session_id": str(session.id),
             "assistant_message": assistant_message.content,